@@ -36,6 +36,7 @@ logging.basicConfig(
 logging.captureWarnings(False)
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True,max_split_size_mb:512,roundup_power2_divisions:4')  # set before CUDA is initialized
 
 
 def parse_args():
@@ -31,6 +31,8 @@ logging.basicConfig(
 )
 logging.captureWarnings(True)
 
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True,max_split_size_mb:512,roundup_power2_divisions:4')  # set before CUDA is initialized
+
 DEFAULT_MODEL_SEED_ARRAY = [1337]
 
 
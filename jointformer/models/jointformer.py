@@ -1,9 +1,11 @@
+import copy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from typing import Optional
+from typing import List, Optional
 
+from jointformer.models.layers.kv_cache import KVCache
 from jointformer.models.trainable import TrainableModel
 from jointformer.models.base import SmilesEncoder
 from jointformer.models.transformer import Transformer
@@ -80,8 +82,14 @@ class Jointformer(Transformer, TrainableModel):
             task: str,
             attention_mask: torch.Tensor,
             next_token_only: Optional[bool] = False,
+            kv_cache: Optional[List[KVCache]] = None,
+            compute_loss: Optional[bool] = False,
             **kwargs
             ):
+
+        # dispatch the loss through `__call__`, so that wrappers such as DDP take part in the loss computation
+        if compute_loss:
+            return self.get_loss(input_ids=input_ids, attention_mask=attention_mask, task=task, **kwargs)
         
         if task == 'generation':
             _is_causal = True
@@ -92,14 +100,17 @@ class Jointformer(Transformer, TrainableModel):
         else:
             raise ValueError('Variable `task` must be either `generation`, `mlm`, `prediction` or `physchem`. Passed value: {}'.format(task))
         
-        outputs = super().forward(input_ids=input_ids, attention_mask=_attention_mask, is_causal=_is_causal)
-        cls_embeddings = self._get_cls_embeddings(outputs['embeddings'], attention_mask=attention_mask)
+        outputs = super().forward(input_ids=input_ids, attention_mask=_attention_mask, is_causal=_is_causal, kv_cache=kv_cache)
+        cls_embeddings = None
         lm_embeddings = self._get_lm_embeddings(outputs['embeddings'], next_token_only)
         # Extract layer_embeddings from Transformer output
         layer_embeddings = outputs.get('layer_embeddings', None)
-        if _is_causal:
+        if task == 'generation':
             outputs["logits_generation"] = self.lm_head(lm_embeddings)
+        elif task == 'mlm':  # the prediction heads are not needed for masked language modeling
+            outputs["logits_generation"] = self.mlm_head(outputs['embeddings'])
         else:
+            cls_embeddings = self._get_cls_embeddings(outputs['embeddings'], attention_mask=attention_mask)
             outputs["logits_physchem"] = self.physchem_head(cls_embeddings)
             outputs["logits_prediction"] = self.prediction_head(cls_embeddings)
             
@@ -117,7 +128,7 @@ class Jointformer(Transformer, TrainableModel):
         )
     
     def predict(self, input_ids: Optional[torch.Tensor] = None, attention_mask: Optional[torch.Tensor] = None, **kwargs):
-        return self.forward(input_ids=input_ids, attention_mask=attention_mask, task='prediction')
+        return self(input_ids=input_ids, attention_mask=attention_mask, task='prediction')
 
     def get_loss(
             self,
@@ -141,26 +152,22 @@ class Jointformer(Transformer, TrainableModel):
     def get_loss_lm(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, input_labels: torch.Tensor, **kwargs):
         outputs = self(input_ids=input_ids, attention_mask=attention_mask, task='generation', next_token_only=False)
         if input_labels is not None: 
-            logits = outputs['logits_generation'][:, :-1, :].contiguous()
-            labels = input_labels[:, 1:].contiguous()
-            batch_size, seq_length, vocab_size = logits.size()
+            logits = outputs['logits_generation'][:, :-1]
+            labels = input_labels[:, 1:]
             outputs["loss"] = F.cross_entropy(
-                logits.view(batch_size * seq_length, vocab_size),
-                labels.view(batch_size * seq_length),
+                logits.reshape(-1, logits.size(-1)),
+                labels.reshape(-1),
                 ignore_index=TOKEN_DICT['ignore'],
                 reduction='mean')
         return outputs
 
     def get_loss_mlm(self, input_ids: torch.Tensor, attention_mask: torch.Tensor, input_labels: torch.Tensor, **kwargs):
-        outputs = self.forward(input_ids=input_ids, attention_mask=attention_mask, task='mlm')
-        outputs["logits_generation"] = self.mlm_head(outputs['embeddings'])
+        outputs = self(input_ids=input_ids, attention_mask=attention_mask, task='mlm')
         if input_labels is not None:
             logits = outputs['logits_generation']
-            labels = input_labels
-            batch_size, seq_length, vocab_size = logits.size()
             outputs["loss"] = F.cross_entropy(
-                logits.view(batch_size * seq_length, vocab_size),
-                labels.view(batch_size * seq_length),
+                logits.reshape(-1, logits.size(-1)),
+                input_labels.reshape(-1),
                 ignore_index=TOKEN_DICT['ignore'],
                 reduction='mean')
         return outputs
@@ -198,14 +205,11 @@ class Jointformer(Transformer, TrainableModel):
         # generate prefix
         prefix = torch.tensor(tokenizer.generation_prefix, device=device).long().unsqueeze(0).expand(batch_size, -1)
 
-        # TODO: implement caching
         idx = self.generate_single_token(prefix, tokenizer.max_molecule_length - 2, temperature, top_k, eos_token_id, pad_token_id)
 
-        # TODO: vectorize
         # check for completion
-        for sequence_idx, sequence in enumerate(idx):
-            if eos_token_id not in sequence:
-                idx[sequence_idx, -1] = eos_token_id
+        has_eos = (idx == eos_token_id).any(dim=1)
+        idx[:, -1].masked_fill_(~has_eos, eos_token_id)
         return idx
 
     @torch.no_grad()
@@ -214,18 +218,26 @@ class Jointformer(Transformer, TrainableModel):
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
-        """
 
+        Keys and values of already processed tokens are cached, so that only the last sampled token
+        is fed to the model at each step.
+        """
+        if eos_token_id is None:
+            raise ValueError("Variable `eos_token_id` must be specified for generation.")
+        if idx.size(1) + max_new_tokens - 1 > self.max_seq_len:
+            raise ValueError(f"Cannot generate {max_new_tokens} tokens from a prefix of length {idx.size(1)}"
+                             f" with a model of maximum sequence length {self.max_seq_len}.")
+
+        kv_cache = self.init_kv_cache()
+        idx_cond = idx
         eos_flag = torch.zeros(size=(idx.size(0), 1), dtype=torch.bool, device=idx.device)
 
         for _ in range(max_new_tokens):
-            if eos_token_id:
-                is_end = torch.logical_or(idx[:, [-1]] == eos_token_id, idx[:, [-1]] == pad_token_id)
-                eos_flag = torch.logical_or(eos_flag, is_end)
-            # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = idx if idx.size(1) <= self.max_seq_len else idx[:, -self.max_seq_len:]
-            # forward the model to get the logits for the index in the sequence
-            outputs = self(input_ids=idx_cond, attention_mask=None, next_token_only=True, task='generation')
+            last_token = idx[:, -1:]
+            eos_flag.logical_or_((last_token == eos_token_id) | (last_token == pad_token_id))
+            # forward the model to get the logits for the index in the sequence; `forward` is called directly
+            # to stay out of the compiled graph, as the growing `idx` would trigger a recompilation at every step
+            outputs = self.forward(input_ids=idx_cond, attention_mask=None, next_token_only=True, task='generation', kv_cache=kv_cache)
             logits = outputs['logits_generation']
 
             # pluck the logits at the final step and scale by desired temperature
@@ -234,22 +246,38 @@ class Jointformer(Transformer, TrainableModel):
             # optionally crop the logits to only the top k options
             if top_k is not None:
                 v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                logits[logits < v[:, [-1]]] = -float('Inf')
+                logits = logits.masked_fill(logits < v[:, -1:], float('-inf'))
 
             # apply softmax to convert logits to (normalized) probabilities
             probs = F.softmax(logits, dim=-1)
 
             # sample from the distribution
             idx_next = torch.multinomial(probs, num_samples=1)
-            idx_next = torch.where(eos_flag, torch.ones_like(idx_next) * pad_token_id, idx_next)
+            idx_next.masked_fill_(eos_flag, pad_token_id)
             # append sampled index to the running sequence and continue
             idx = torch.cat((idx, idx_next), dim=1)
+            idx_cond = idx_next
 
         return idx
 
-    def to_guacamole_generator(self, tokenizer, batch_size, temperature, top_k, device) -> 'DistributionMatchingGenerator':
+    def quantize_lm_head(self) -> 'Jointformer':
+        """ Returns a CPU copy of the model with the generation head dynamically quantized to int8.
+
+        The quantized head is untied from the token embedding and runs on CPU only.
+        """
+        model = copy.deepcopy(self).cpu()
+        return torch.ao.quantization.quantize_dynamic(model, {'lm_head'}, dtype=torch.qint8, inplace=True)
+
+    def to_guacamole_generator(
+            self, tokenizer, batch_size, temperature, top_k, device, quantize_lm_head: bool = False
+            ) -> 'DistributionMatchingGenerator':
         from jointformer.models.wrappers import JointformerSmilesGeneratorWrapper
-        return JointformerSmilesGeneratorWrapper(self, tokenizer, batch_size, temperature, top_k, device)
+        model = self
+        if quantize_lm_head:
+            if torch.device(device).type != 'cpu':
+                raise ValueError('Generation with a quantized `lm_head` is only supported on `cpu`.')
+            model = self.quantize_lm_head()
+        return JointformerSmilesGeneratorWrapper(model, tokenizer, batch_size, temperature, top_k, device)
 
     def to_smiles_encoder(self, tokenizer, batch_size, device) -> SmilesEncoder:
         from jointformer.models.wrappers import JointformerSmilesEncoderWrapper
@@ -282,16 +310,14 @@ class Jointformer(Transformer, TrainableModel):
 class JointformerWithPrefix(Jointformer):
 
     def _get_lm_embeddings(self, embeddings, next_token_only):
-        return super()._get_lm_embeddings(embeddings[:, 1:], next_token_only)
+        # with `next_token_only` the prefix is never selected, and cached generation feeds a single token
+        return super()._get_lm_embeddings(embeddings if next_token_only else embeddings[:, 1:], next_token_only)
 
 
 class JointformerWithMaxEmbeddings(Jointformer):
 
     def _get_cls_embeddings(self, embeddings, attention_mask=None):
-        _, _, embedding_dim = embeddings.size()
         if attention_mask is not None:
-            attention_mask = attention_mask.unsqueeze(-1).repeat(1, 1, embedding_dim)
-            embeddings = embeddings.masked_fill(attention_mask.logical_not(), float("-inf"))
-        embeddings = embeddings.max(dim=1).values
-        return embeddings
+            embeddings = embeddings.masked_fill(attention_mask.logical_not().unsqueeze(-1), float("-inf"))
+        return embeddings.amax(dim=1)
     
\ No newline at end of file
@@ -5,9 +5,22 @@ import warnings
 import torch.nn as nn
 import torch.nn.functional as F
 
+from contextlib import nullcontext
 from typing import Optional
 
 from jointformer.models.layers.rotary import RotaryPositionalEmbedding
+from jointformer.models.layers.kv_cache import KVCache
+
+try:  # torch >= 2.3
+    from torch.nn.attention import SDPBackend, sdpa_kernel
+
+    def fused_sdpa_kernel():
+        """ Restricts `F.scaled_dot_product_attention` to the Flash and memory-efficient kernels. """
+        return sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION])
+except ImportError:
+    def fused_sdpa_kernel():
+        """ Restricts `F.scaled_dot_product_attention` to the Flash and memory-efficient kernels. """
+        return torch.backends.cuda.sdp_kernel(enable_flash=True, enable_mem_efficient=True, enable_math=False)
 
 
 class Attention(nn.Module):
@@ -16,6 +29,7 @@ class Attention(nn.Module):
         self.embedding_dim = embedding_dim
         self.num_heads = num_heads
         self.head_dim = embedding_dim // num_heads
+        self.scale = 1.0 / math.sqrt(self.head_dim)
         self.bias = bias
         self.dropout = dropout
         self.block_size = block_size
@@ -33,38 +47,46 @@ class Attention(nn.Module):
         self.out = nn.Linear(self.embedding_dim, self.embedding_dim, bias=bias)
         self.relative_embedding = RotaryPositionalEmbedding(self.head_dim)
 
-    def forward(self, x: torch.Tensor, attn_mask: torch.Tensor, is_causal: bool) -> torch.Tensor:
+    def forward(
+            self, x: torch.Tensor, attn_mask: torch.Tensor, is_causal: bool, kv_cache: Optional[KVCache] = None
+            ) -> torch.Tensor:
         """ Forward pass of the attention layer.
 
         Args:
             x (torch.Tensor): Input tensor of shape (batch_size, seq_len, embedding_dim)
-            attn_mask (torch.Tensor): Mask tensor of shape (batch_size, seq_len) and type torch.bool
+            attn_mask (torch.Tensor): Mask tensor of shape (batch_size, seq_len) and type torch.bool. With a non-empty
+                `kv_cache`, either None for a single query or a mask of shape (seq_len, cached_len + seq_len)
             is_causal (bool): If True, the model is autoregressive and variable `mask` is ignored
+            kv_cache (KVCache, optional): Cache of keys and values of the preceding tokens, used for
+                autoregressive generation. Updated in-place with the keys and values of `x`
         
         Returns:
             torch.Tensor: Output tensor of shape (batch_size, seq_len, embedding_dim)
         
         """
         batch_size, seq_len, embedding_dim = x.shape 
+        offset = kv_cache.seq_len if kv_cache is not None else 0
         
-        q, k, v = self.qkv(x).split(embedding_dim, dim=-1)
-
-        q = q.view(batch_size, seq_len, self.num_heads, self.head_dim)
-        k = k.view(batch_size, seq_len, self.num_heads, self.head_dim)
-        v = v.view(batch_size, seq_len, self.num_heads, self.head_dim)
+        # (batch_size, seq_len, 3, num_heads, head_dim), unbound into views of shape (batch_size, seq_len, num_heads, head_dim)
+        q, k, v = self.qkv(x).view(batch_size, seq_len, 3, self.num_heads, self.head_dim).unbind(dim=2)
 
-        q = self.relative_embedding(q)
-        k = self.relative_embedding(k)
+        q = self.relative_embedding(q, offset=offset)
+        k = self.relative_embedding(k, offset=offset)
 
         q = q.transpose(1, 2)
         k = k.transpose(1, 2)
         v = v.transpose(1, 2) 
 
-        attn_mask = None if is_causal else attn_mask.unsqueeze(1).unsqueeze(1).expand(batch_size, self.num_heads, seq_len, seq_len)
+        if kv_cache is not None:
+            k, v = kv_cache.update(k, v)
+
+        if offset == 0:  # with a non-empty cache, the mask is prepared by the caller
+            attn_mask = None if is_causal else attn_mask.unsqueeze(1).unsqueeze(1).expand(batch_size, self.num_heads, seq_len, seq_len)
         
         if self.flash_attention:
-            y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, 
-                is_causal=is_causal, dropout_p=self.dropout if self.training else 0.)
+            with fused_sdpa_kernel() if q.is_cuda else nullcontext():
+                y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, 
+                    is_causal=is_causal, dropout_p=self.dropout if self.training else 0., scale=self.scale)
         else:
             y = self.scaled_dot_product_attention(q, k, v, seq_len, attn_mask=attn_mask, is_causal=is_causal)
             
@@ -74,10 +96,10 @@ class Attention(nn.Module):
         return y
     
     def scaled_dot_product_attention(self, q, k, v, seq_len, attn_mask, is_causal) -> torch.Tensor:
-        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+        att = (q @ k.transpose(-2, -1)) * self.scale
         if is_causal:
             att = att.masked_fill(self.mask_causal[:, :, :seq_len, :seq_len] == 0, float('-inf'))
-        else:
+        elif attn_mask is not None:
             att = att.masked_fill(attn_mask.int() == 0, float('-inf'))
         att_probs = F.softmax(att, dim=-1)
         y = self.attn_dropout(att_probs) @ v  # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
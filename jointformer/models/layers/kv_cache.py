@@ -0,0 +1,35 @@
+import torch
+
+from typing import Tuple
+
+
+class KVCache:
+    """ Key-value cache of a single attention layer, used for autoregressive generation.
+
+    Cache tensors of shape (batch_size, num_heads, max_seq_len, head_dim) are allocated once, on the first update,
+    and filled in-place as the sequence grows.
+    """
+
+    def __init__(self, max_seq_len: int):
+        self.max_seq_len = max_seq_len
+        self.seq_len = 0
+        self._k = None
+        self._v = None
+
+    def update(self, k: torch.Tensor, v: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Appends keys and values of shape (batch_size, num_heads, seq_len, head_dim) to the cache.
+
+        Returns:
+            Tuple[torch.Tensor, torch.Tensor]: All cached keys and values, including the appended ones
+        """
+        start, end = self.seq_len, self.seq_len + k.size(2)
+        if end > self.max_seq_len:
+            raise ValueError(f"Sequence of length {end} exceeds the cache capacity of {self.max_seq_len}.")
+        if self._k is None:
+            batch_size, num_heads, _, head_dim = k.shape
+            self._k = k.new_empty(batch_size, num_heads, self.max_seq_len, head_dim)
+            self._v = v.new_empty(batch_size, num_heads, self.max_seq_len, head_dim)
+        self._k[:, :, start:end] = k
+        self._v[:, :, start:end] = v
+        self.seq_len = end
+        return self._k[:, :, :end], self._v[:, :, :end]
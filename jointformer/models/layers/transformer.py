@@ -1,8 +1,11 @@
 import torch
 import torch.nn as nn
 
+from typing import Optional
+
 from jointformer.models.layers.layer_norm import RMSNorm
 from jointformer.models.layers.attention import Attention
+from jointformer.models.layers.kv_cache import KVCache
 from jointformer.models.layers.mlp import FeedForward
 
 
@@ -17,7 +20,7 @@ class TransformerLayer(nn.Module):
         self.attention_layer_normalization = RMSNorm(embedding_dim, layer_norm_eps)
         self.feed_forward_normalization = RMSNorm(embedding_dim, layer_norm_eps)
         
-    def forward(self, x: torch.Tensor, is_causal: bool, mask: torch.Tensor = None) -> torch.Tensor:
-        x = x + self.attention_layer(x=self.attention_layer_normalization(x), is_causal=is_causal, attn_mask=mask)
+    def forward(self, x: torch.Tensor, is_causal: bool, mask: torch.Tensor = None, kv_cache: Optional[KVCache] = None) -> torch.Tensor:
+        x = x + self.attention_layer(x=self.attention_layer_normalization(x), is_causal=is_causal, attn_mask=mask, kv_cache=kv_cache)
         x = x + self.feed_forward(self.feed_forward_normalization(x))
         return x
@@ -4,8 +4,9 @@ import torch
 
 import torch.nn as nn
 
-from typing import Optional
+from typing import List, Optional
 
+from jointformer.models.layers.kv_cache import KVCache
 from jointformer.models.layers.layer_norm import RMSNorm
 from jointformer.models.layers.transformer import TransformerLayer
 from jointformer.models.utils import ModelOutput
@@ -43,20 +44,31 @@ class Transformer(nn.Module):
             input_ids: torch.Tensor,
             is_causal: bool,
             attention_mask: torch.Tensor,
+            kv_cache: Optional[List[KVCache]] = None,
             **kwargs
     ) -> ModelOutput:
         #assert False, (self.token_embedding, input_ids)
+        mask = attention_mask
+        offset = kv_cache[0].seq_len if kv_cache is not None else 0
+        if offset > 0:  # a single query attends to all cached keys, a chunk of queries also causally to each other
+            seq_len = input_ids.size(1)
+            mask = None if seq_len == 1 else torch.ones(
+                seq_len, offset + seq_len, dtype=torch.bool, device=input_ids.device).tril(diagonal=offset)
+            is_causal = False
         x = self.token_embedding(input_ids)
         # List to store embeddings from each layer
         # Start with initial embeddings (before any TransformerLayer)
         layer_embeddings = [x]
-        for _, layer in enumerate(self.layers):
-            x = layer(x, is_causal=is_causal, mask=attention_mask)
+        for layer_idx, layer in enumerate(self.layers):
+            x = layer(x, is_causal=is_causal, mask=mask, kv_cache=kv_cache[layer_idx] if kv_cache is not None else None)
             layer_embeddings.append(x)
         x = self.layer_norm(x)
         layer_embeddings[-1] = x
         return ModelOutput(embeddings=x, attention_mask=attention_mask,layer_embeddings = layer_embeddings)
 
+    def init_kv_cache(self) -> List[KVCache]:
+        return [KVCache(self.max_seq_len) for _ in range(self.num_layers)]
+
     def load_pretrained(self, filename, device='cpu'):
         state_dict = torch.load(filename, map_location=device, weights_only=True)['model']
         unwanted_prefix = '_orig_mod.'  # compile
@@ -68,7 +68,7 @@ class Trainer:
         self.gradient_accumulation_steps = config.gradient_accumulation_steps
         self.batch_size = config.batch_size
         self.block_size = config.block_size
-        self.dtype = config.dtype
+        self.dtype = config.dtype  # bfloat16 is recommended on Ampere or newer GPUs, as it needs no gradient scaling
         if self.dtype == 'bfloat16':
             if not torch.cuda.is_available() or not torch.cuda.is_bf16_supported():
                 self.dtype = 'float16'
@@ -140,6 +140,7 @@ class Trainer:
         
         set_seed(self.seed + self.seed_offset)
         self.model.to(self.device)
+        self.raw_model = self.model  # unwrapped model, updated once the model is wrapped in DDP
         self.optimizer = self.model.configure_optimizers(
             self.weight_decay, self.learning_rate, (self.beta1, self.beta2), self.device_type)
 
@@ -156,19 +157,20 @@ class Trainer:
         self.ctx = nullcontext() if self.device_type == 'cpu' else torch.amp.autocast(
             device_type=self.device_type, dtype=self.ptdtype)
 
-        self.scaler = torch.cuda.amp.GradScaler(enabled=(self.dtype == 'float16'))
+        self.scaler = torch.cuda.amp.GradScaler(enabled=(self.dtype == 'float16'))  # only fp16 requires loss scaling
 
         if self.out_dir is not None:
             if not os.path.isdir(self.out_dir) and self.master_process:
                 os.makedirs(self.out_dir, exist_ok=False)
 
     def _compile(self):
-        if self.compile:
-            self.model = torch.compile(self.model, mode='reduce-overhead', fullgraph=True, dynamic=True)
+        if self.compile:  # compile in-place, so that the loss computed within `forward` uses the compiled graph
+            self.model.compile(mode='reduce-overhead', fullgraph=False, dynamic=False)
 
     def _parallelize(self):
-        if self.is_ddp:
-            self.model = DDP(self.model, device_ids=[self.ddp_local_rank])
+        if self.is_ddp and not isinstance(self.model, DDP):  # model is already on `self.device`, see `_post_init`
+            self.model = DDP(  # heads of tasks not sampled in an iteration receive no gradients
+                self.model, device_ids=[self.ddp_local_rank], gradient_as_bucket_view=True, find_unused_parameters=True)
 
     def resume_snapshot(self):
         self.resume_from_file(self._snapshot_filepath)
@@ -249,7 +251,7 @@ class Trainer:
 
     def get_batch(self, split, task):
         batch = self._sample(self.train_dataset, task) if split == 'train' else self._sample(self.val_dataset, task)
-        return batch.to(self.device)
+        return batch.to(self.device)  # pinned, non-blocking host-to-device copy
         
     def _sample(self, dataset, task):
         idx = [idx for idx in range(len(dataset))]
@@ -296,8 +298,8 @@ class Trainer:
 
     @torch.no_grad()
     def estimate_loss(self):
-
-        self.model.eval()
+        # evaluation runs on the master process only, so it must bypass the DDP wrapper
+        self.raw_model.eval()
         out = {}
         splits = []
         if self.train_dataset:
@@ -309,13 +311,15 @@ class Trainer:
         for split in splits:
             out[split] = {}
             for task in tasks:
-                losses = torch.zeros(self.eval_iters)
+                losses = torch.empty(self.eval_iters, device=self.device)  # kept on device to avoid a sync per iteration
+                inputs = self.get_batch(split, task)
                 for k in range(self.eval_iters):
-                    inputs = self.get_batch(split, task)
                     with self.ctx:
-                        outputs = self.model.get_loss(**inputs)
-                    losses[k] = outputs["loss"].item() if outputs["loss"] is not None else torch.nan
-                out[split][task] = losses.mean().item() if torch.nan not in losses else torch.nan
+                        outputs = self.raw_model(**inputs, compute_loss=True)
+                    if k < self.eval_iters - 1:
+                        inputs = self.get_batch(split, task)  # async prefetch next batch
+                    losses[k] = outputs["loss"].detach() if outputs["loss"] is not None else torch.nan
+                out[split][task] = losses.mean().item()  # NaN if any loss is missing
 
         for split in splits:
             for task in tasks:
@@ -324,18 +328,20 @@ class Trainer:
                 else:
                     out[split]['combined'] = out[split][task]
 
-        if hasattr(self.model, 'calculate_perplexity') and self.eval_generation:
+        if hasattr(self.raw_model, 'calculate_perplexity') and self.eval_generation:
             for split in splits:
                 out[split]['perplexity'] = {}
-                losses = torch.zeros(self.eval_iters)
+                losses = torch.empty(self.eval_iters, device=self.device)
+                inputs = self.get_batch(split, task='generation')
                 for k in range(self.eval_iters):
-                    inputs = self.get_batch(split, task='generation')
                     with self.ctx:
-                        perplexity = self.model.calculate_perplexity(**inputs)
+                        perplexity = self.raw_model.calculate_perplexity(**inputs)
+                    if k < self.eval_iters - 1:
+                        inputs = self.get_batch(split, task='generation')  # async prefetch next batch
                     losses[k] = perplexity.mean()
-                out[split]['perplexity'] = losses.mean().item() if torch.nan not in losses else torch.nan
+                out[split]['perplexity'] = losses.mean().item()
 
-        if hasattr(self.model, 'generate') and self.eval_generation:
+        if hasattr(self.raw_model, 'generate') and self.eval_generation:
             samples = []
             for _ in range(self.eval_iters):
                 samples.extend(self.generate())
@@ -345,26 +351,33 @@ class Trainer:
             out["val"]["validity"] = sum(is_valid_batch) / len(is_valid_batch)
             out["val"]["uniqueness"] = len(set(samples)) / len(samples)
             out["val"]["novelty"] = len(set(samples) - set(self.train_dataset.data)) / len(samples)
-        self.model.train()
+        self.raw_model.train()
         return out
 
-    def _get_lr(self):
+    def _get_lr_multiplier(self, it: int) -> float:
+        """ Learning rate at iteration `it`, relative to `self.learning_rate`. """
+        if not self.decay_lr:
+            return 1.0
         # 1) linear warmup for warmup_iters steps
-        if self._iter_num < self.warmup_iters:
-            return self.learning_rate * self._iter_num / self.warmup_iters
+        if it < self.warmup_iters:
+            return it * self._inv_warmup_iters
         # 2) if it > lr_decay_iters, return min learning rate
-        if self._iter_num > self.lr_decay_iters:
-            return self.min_lr
+        if it > self.lr_decay_iters:
+            return self._min_lr_ratio
         # 3) in between, use cosine decay down to min learning rate
-        decay_ratio = (self._iter_num - self.warmup_iters) / (self.lr_decay_iters - self.warmup_iters)
+        decay_ratio = (it - self.warmup_iters) * self._inv_decay_iters
         assert 0 <= decay_ratio <= 1
         coeff = 0.5 * (1.0 + math.cos(math.pi * decay_ratio))  # coeff ranges 0..1
-        return self.min_lr + coeff * (self.learning_rate - self.min_lr)
+        return self._min_lr_ratio + coeff * (1.0 - self._min_lr_ratio)
 
-    def _set_lr(self) -> None:
-        self._learning_rate = self._get_lr() if self.decay_lr else self.learning_rate
-        for param_group in self.optimizer.param_groups:
-            param_group['lr'] = self._learning_rate
+    def _init_scheduler(self) -> None:
+        self._inv_warmup_iters = 1.0 / self.warmup_iters if self.warmup_iters > 0 else 0.0
+        self._inv_decay_iters = 1.0 / (self.lr_decay_iters - self.warmup_iters) if self.lr_decay_iters > self.warmup_iters else 0.0
+        self._min_lr_ratio = self.min_lr / self.learning_rate
+        for param_group in self.optimizer.param_groups:  # base lr, as a resumed optimizer holds the decayed one
+            param_group['initial_lr'] = self.learning_rate
+        self.scheduler = torch.optim.lr_scheduler.LambdaLR(
+            self.optimizer, self._get_lr_multiplier, last_epoch=self._iter_num - 1)
 
     def evaluate(self):
         if self._iter_num % self.eval_interval == 0 and self.master_process and (self._resumed_from_iter_num != self._iter_num or self._iter_num ==  0):
@@ -409,7 +422,7 @@ class Trainer:
 
     @torch.no_grad()
     def generate(self, temperature=1.0, top_k=25):
-        samples = self.model.generate(
+        samples = self.raw_model.generate(
             tokenizer=self.tokenizer,
             batch_size=self.batch_size,
             temperature = temperature,
@@ -426,6 +439,7 @@ class Trainer:
         self._compile()
         self._parallelize()
         self._init_data_loaders()
+        self._init_scheduler()
 
         if self.logger is not None and self.master_process:
             self.logger.init_run()
@@ -443,7 +457,7 @@ class Trainer:
                     self.logger.finish()
                 break
                 
-            self._set_lr()
+            self._learning_rate = self.scheduler.get_last_lr()[0]
             self.evaluate()
             if self._iter_num == 0 and self.eval_only:
                 if self.logger is not None:
@@ -452,19 +466,28 @@ class Trainer:
             
             ### Training step
             for micro_step in range(self.gradient_accumulation_steps): # gradient accumulation loop
-                if self.is_ddp:
-                    self.model.require_backward_grad_sync = (micro_step == self.gradient_accumulation_steps - 1)  # in ddp mode, only sync grads at the last micro-step
-                with self.ctx:
-                    outputs = self.model.get_loss(**inputs)
-                    loss = outputs["loss"] / self.gradient_accumulation_steps  # scale the loss to account for gradient accumulation
-                inputs = self.get_training_batch()  # async prefetch next batch
-                self.scaler.scale(loss).backward()  # backward pass, with gradient scaling if training in fp16
+                # in ddp mode, only sync grads at the last micro-step; forward must run inside `no_sync` as well
+                _is_last_micro_step = micro_step == self.gradient_accumulation_steps - 1
+                sync_ctx = self.model.no_sync() if self.is_ddp and not _is_last_micro_step else nullcontext()
+                with sync_ctx:
+                    with self.ctx:
+                        outputs = self.model(**inputs, compute_loss=True)  # through the DDP forward, so that `no_sync` applies
+                        loss = outputs["loss"] / self.gradient_accumulation_steps  # scale the loss to account for gradient accumulation
+                    inputs = self.get_training_batch()  # async prefetch next batch
+                    if self.scaler.is_enabled():
+                        self.scaler.scale(loss).backward()  # backward pass, with gradient scaling if training in fp16
+                    else:
+                        loss.backward()
             
             if self.grad_clip != 0.0: # clip the gradient
-                self.scaler.unscale_(self.optimizer)
+                if self.scaler.is_enabled():
+                    self.scaler.unscale_(self.optimizer)
                 torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.grad_clip)
-            self.scaler.step(self.optimizer) # step the optimizer and scaler if training in fp16
-            self.scaler.update()
+            if self.scaler.is_enabled():
+                self.scaler.step(self.optimizer) # step the optimizer and scaler if training in fp16
+                self.scaler.update()
+            else:
+                self.optimizer.step()
             self.optimizer.zero_grad(set_to_none=True) # flush the gradients
             ###
 
@@ -483,5 +506,6 @@ class Trainer:
                         )
                     if self.save_snapshot:
                         self._save_ckpt(SNAPSHOT_FILENAME)
+            self.scheduler.step()
             self._iter_num += 1
             local_iter_num += 1
@@ -5,7 +5,12 @@ Source:
     [2] https://github.com/BenevolentAI/MolBERT/blob/main/molbert/utils/featurizer/molfeaturizer.py#L1346
 """
 
-from typing import Iterable, List, Optional
+import os
+import math
+
+from functools import partial
+from multiprocessing import get_context
+from typing import Callable, Iterable, List, Optional
 from rdkit import Chem
 
 from jointformer.utils.data import remove_duplicates
@@ -14,6 +19,35 @@ from jointformer.utils.data import remove_duplicates
 from rdkit import RDLogger
 RDLogger.logger().setLevel(RDLogger.CRITICAL)
 
+MAX_NUM_WORKERS = 16
+MIN_PARALLEL_LENGTH = 5000
+
+_pool = None
+
+
+def _get_num_workers() -> int:
+    num_workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    return min(num_workers, MAX_NUM_WORKERS)
+
+
+def _get_pool():
+    """ Returns a process pool, created once per process. Workers are spawned rather than forked, so that
+    the pool is safe to use from processes holding a CUDA context or running threads. """
+    global _pool
+    if _pool is None:
+        _pool = get_context('spawn').Pool(_get_num_workers())
+    return _pool
+
+
+def _parallel_map(fn: Callable, iterable: Iterable) -> list:
+    """ Maps `fn` over `iterable` in a process pool, preserving order. Short inputs are mapped serially. """
+    items = list(iterable)
+    num_workers = _get_num_workers()
+    if len(items) < MIN_PARALLEL_LENGTH or num_workers < 2:
+        return [fn(item) for item in items]
+    chunksize = math.ceil(len(items) / (4 * num_workers))
+    return _get_pool().map(fn, items, chunksize=chunksize)
+
 
 def standardize(smiles: str, canonicalize: bool = False) -> Optional[str]:
     """
@@ -59,6 +93,7 @@ def is_valid(smiles: str):
     return smiles != '' and mol is not None and mol.GetNumAtoms() > 0
 
 
+
 def canonicalize(smiles: str, include_stereocenters=True) -> Optional[str]:
     """
     Canonicalize the SMILES strings with RDKit.
@@ -93,7 +128,7 @@ def canonicalize_list(smiles_list: Iterable[str], include_stereocenters=True) ->
         The canonicalized and filtered input smiles.
     """
 
-    canonicalized_smiles = [canonicalize(smiles, include_stereocenters) for smiles in smiles_list]
+    canonicalized_smiles = _parallel_map(partial(canonicalize, include_stereocenters=include_stereocenters), smiles_list)
 
     # Remove None elements
     canonicalized_smiles = [s for s in canonicalized_smiles if s is not None]